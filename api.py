@@ -1,8 +1,14 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends
+import asyncio
+import hashlib
+import hmac
+import logging
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, BackgroundTasks, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from pydantic import BaseModel
+from sqlalchemy import select, insert, update, delete, func
+from pydantic import BaseModel, ConfigDict, TypeAdapter
+from datetime import datetime
 from typing import List, Optional
 from PyPDF2 import PdfReader
 from io import BytesIO
@@ -10,12 +16,14 @@ from io import BytesIO
 # Import from other files
 from database import (
     get_db, init_db, User, Conversation, Message, 
-    Document, DocumentChunk, ConversationDocument, new_id
+    Document, DocumentChunk, ConversationDocument, new_id,
+    purge_document, purge_conversation, purge_pending
 )
-from llm_service import LLMService, RAGService
+from llm_service import LLMService, RAGService, ContextService, content_hash, retrieval_cache
+from profiler import PROFILING_ENABLED, PROFILE_ADMIN_TOKEN, ProfilerMiddleware, profiles
 
 # Initialize FastAPI
-app = FastAPI(title="BOT GPT API")
+app = FastAPI(title="BOT GPT API", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -25,9 +33,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Only installed when enabled, so there is no per-request cost otherwise
+if PROFILING_ENABLED:
+    app.add_middleware(ProfilerMiddleware)
+
+logger = logging.getLogger(__name__)
+background = set()
+
+def log_task_result(task: asyncio.Task):
+    background.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error("Background task failed", exc_info=task.exception())
+
 @app.on_event("startup")
 async def startup():
     await init_db()
+    task = asyncio.create_task(purge_pending())
+    background.add(task)
+    task.add_done_callback(log_task_result)
 
 # SCHEMAS
 class UserCreate(BaseModel):
@@ -43,6 +66,71 @@ class MessageCreate(BaseModel):
     content: str
 
 
+# Response models validate straight from the selected result rows
+class RowModel(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+class UserOut(RowModel):
+    id: str
+    name: str
+    email: str
+
+class UserList(BaseModel):
+    users: List[UserOut]
+
+class ConversationOut(RowModel):
+    id: str
+    mode: Optional[str]
+    title: Optional[str]
+    created_at: Optional[datetime]
+    total_tokens: Optional[int]
+
+class ConversationList(BaseModel):
+    conversations: List[ConversationOut]
+
+class MessageOut(RowModel):
+    role: Optional[str]
+    content: str
+    created_at: Optional[datetime]
+
+class ConversationDetail(BaseModel):
+    id: str
+    mode: Optional[str]
+    title: Optional[str]
+    messages: List[MessageOut]
+
+class DocumentOut(RowModel):
+    id: str
+    filename: str
+    chunks: int
+    created_at: Optional[datetime]
+
+user_list = TypeAdapter(UserList)
+conversation_list = TypeAdapter(ConversationList)
+document_list = TypeAdapter(List[DocumentOut])
+
+
+# Lists carry an ETag so clients can revalidate and get 304 when nothing changed
+def etag_response(request: Request, adapter: TypeAdapter, data) -> Response:
+    body = adapter.dump_json(adapter.validate_python(data, from_attributes=True))
+    etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+    
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(body, media_type="application/json", headers={"ETag": etag})
+
+
+# Deletes only set a flag, so writers re-check it once their rows are flushed.
+# SQLite allows a single writer, so a purge can't run between this and commit.
+async def ensure_not_deleting(db: AsyncSession, model, row_id: str, detail: str):
+    await db.flush()
+    result = await db.execute(select(model.deleting).where(model.id == row_id))
+    if result.scalar_one_or_none() is not False:
+        await db.rollback()
+        raise HTTPException(404, detail)
+
+
 # USER ROUTES
 @app.post("/users")
 async def create_user(data: UserCreate, db: AsyncSession = Depends(get_db)):
@@ -58,17 +146,10 @@ async def create_user(data: UserCreate, db: AsyncSession = Depends(get_db)):
     
     return {"id": user.id, "name": user.name, "email": user.email}
 
-@app.get("/users")
-async def list_users(db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(User))
-    users = result.scalars().all()
-    
-    return {
-        "users": [
-            {"id": u.id, "name": u.name, "email": u.email}
-            for u in users
-        ]
-    }
+@app.get("/users", response_model=UserList)
+async def list_users(request: Request, db: AsyncSession = Depends(get_db)):
+    result = await db.execute(select(User.id, User.name, User.email))
+    return etag_response(request, user_list, {"users": result.all()})
 
 
 # CONVERSATION ROUTES
@@ -83,14 +164,14 @@ async def create_conversation(data: ConversationCreate, db: AsyncSession = Depen
         title=title
     )
     db.add(conv)
-    await db.flush()
     
-    # Add user message
+    # Add user message (nothing is written until the final commit)
     user_msg = Message(
         id=new_id(),
         conversation_id=conv.id,
         role="user",
-        content=data.first_message
+        content=data.first_message,
+        created_at=datetime.utcnow()
     )
     db.add(user_msg)
     
@@ -120,20 +201,22 @@ async def create_conversation(data: ConversationCreate, db: AsyncSession = Depen
 @app.post("/conversations/{conv_id}/messages")
 async def add_message(conv_id: str, data: MessageCreate, db: AsyncSession = Depends(get_db)):
     # Get conversation
-    result = await db.execute(select(Conversation).where(Conversation.id == conv_id))
+    result = await db.execute(
+        select(Conversation).where(Conversation.id == conv_id, Conversation.deleting.is_(False))
+    )
     conv = result.scalar_one_or_none()
     if not conv:
         raise HTTPException(404, "Conversation not found")
     
-    # Save user message
+    # Nothing is written until the reply is back, so the SQLite write lock is
+    # held only for the final commit, not across retrieval, summaries and the LLM
     user_msg = Message(
         id=new_id(),
         conversation_id=conv_id,
         role="user",
-        content=data.content
+        content=data.content,
+        created_at=datetime.utcnow()
     )
-    db.add(user_msg)
-    await db.flush()
     
     # Prepare LLM messages
     llm_messages = []
@@ -148,7 +231,7 @@ async def add_message(conv_id: str, data: MessageCreate, db: AsyncSession = Depe
         doc_ids = [link.document_id for link in doc_links]
         
         if doc_ids:
-            chunks = await RAGService.retrieve_chunks(db, doc_ids, data.content)
+            chunks = await RAGService.retrieve_chunks(db, doc_ids, data.content, conversation_id=conv_id)
             if chunks:
                 context = "\n\n".join([f"CHUNK {i+1}:\n{c}" for i, c in enumerate(chunks)])
                 llm_messages.append({
@@ -156,23 +239,26 @@ async def add_message(conv_id: str, data: MessageCreate, db: AsyncSession = Depe
                     "content": f"Answer based on this context:\n\n{context}"
                 })
     
-    # Add user message
-    llm_messages.append({"role": "user", "content": data.content})
+    # Add history (ends with the new user message), compacting older turns
+    history = await ContextService.build_history(db, conv, data.content)
+    llm_messages.extend(history["messages"])
     
     # Get AI response
     response = await LLMService.chat(llm_messages)
     
-    # Save AI message
+    # Save both messages
     ai_msg = Message(
         id=new_id(),
         conversation_id=conv_id,
         role="assistant",
         content=response["content"],
-        tokens=response["tokens"]
+        tokens=response["tokens"],
+        created_at=datetime.utcnow()
     )
-    db.add(ai_msg)
+    db.add_all([user_msg, ai_msg])
     
-    conv.total_tokens += response["tokens"]
+    conv.total_tokens += response["tokens"] + history["tokens"]
+    await ensure_not_deleting(db, Conversation, conv_id, "Conversation not found")
     await db.commit()
     
     return {
@@ -180,61 +266,105 @@ async def add_message(conv_id: str, data: MessageCreate, db: AsyncSession = Depe
         "tokens": response["tokens"]
     }
 
-@app.get("/conversations")
-async def list_conversations(user_id: str, db: AsyncSession = Depends(get_db)):
+@app.get("/conversations", response_model=ConversationList)
+async def list_conversations(user_id: str, request: Request, db: AsyncSession = Depends(get_db)):
     result = await db.execute(
-        select(Conversation)
-        .where(Conversation.user_id == user_id)
+        select(
+            Conversation.id, Conversation.mode, Conversation.title,
+            Conversation.created_at, Conversation.total_tokens
+        )
+        .where(Conversation.user_id == user_id, Conversation.deleting.is_(False))
         .order_by(Conversation.updated_at.desc())
     )
-    convs = result.scalars().all()
-    
-    return {
-        "conversations": [
-            {
-                "id": c.id,
-                "mode": c.mode,
-                "title": c.title,
-                "created_at": str(c.created_at),
-                "total_tokens": c.total_tokens
-            }
-            for c in convs
-        ]
-    }
+    return etag_response(request, conversation_list, {"conversations": result.all()})
 
-@app.get("/conversations/{conv_id}")
+@app.get("/conversations/{conv_id}", response_model=ConversationDetail)
 async def get_conversation(conv_id: str, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(Conversation).where(Conversation.id == conv_id))
-    conv = result.scalar_one_or_none()
+    result = await db.execute(
+        select(Conversation.id, Conversation.mode, Conversation.title)
+        .where(Conversation.id == conv_id, Conversation.deleting.is_(False))
+    )
+    conv = result.one_or_none()
     if not conv:
         raise HTTPException(404, "Not found")
     
+    result = await db.execute(
+        select(Message.role, Message.content, Message.created_at)
+        .where(Message.conversation_id == conv_id)
+        .order_by(Message.created_at)
+    )
+    
     return {
         "id": conv.id,
         "mode": conv.mode,
         "title": conv.title,
-        "messages": [
-            {"role": m.role, "content": m.content, "created_at": str(m.created_at)}
-            for m in conv.messages
-        ]
+        "messages": result.all()
     }
 
 @app.delete("/conversations/{conv_id}")
-async def delete_conversation(conv_id: str, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(Conversation).where(Conversation.id == conv_id))
-    conv = result.scalar_one_or_none()
-    if conv:
-        await db.delete(conv)
-        await db.commit()
+async def delete_conversation(conv_id: str, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db)):
+    # Hide it now; messages are removed in batches after the response
+    result = await db.execute(
+        update(Conversation)
+        .where(Conversation.id == conv_id, Conversation.deleting.is_(False))
+        .values(deleting=True)
+    )
+    await db.commit()
+    retrieval_cache.invalidate_conversation(conv_id)
+    if result.rowcount:
+        background_tasks.add_task(purge_conversation, conv_id)
     return {"status": "deleted"}
 
 
 # DOCUMENT ROUTES
 @app.post("/documents/upload")
 async def upload_document(file: UploadFile = File(...), db: AsyncSession = Depends(get_db)):
-    # Extract text
     content = await file.read()
+    user_id = "test-user"  # TODO: use real auth
+    file_hash = content_hash(content)
     
+    # Same file seen before: reuse its chunks instead of extracting and embedding again
+    result = await db.execute(
+        select(Document)
+        .where(Document.content_hash == file_hash, Document.deleting.is_(False))
+        .order_by((Document.user_id == user_id).desc())
+        .limit(1)
+    )
+    existing = result.scalar_one_or_none()
+    if existing:
+        if existing.user_id == user_id:
+            count = await db.scalar(
+                select(func.count(DocumentChunk.id)).where(DocumentChunk.document_id == existing.id)
+            )
+            return {
+                "document_id": existing.id,
+                "filename": existing.filename,
+                "chunks": count
+            }
+        
+        doc = Document(id=new_id(), user_id=user_id, filename=file.filename, content_hash=file_hash)
+        db.add(doc)
+        await db.flush()
+        
+        result = await db.execute(
+            select(DocumentChunk.content, DocumentChunk.content_hash, DocumentChunk.embedding)
+            .where(DocumentChunk.document_id == existing.id)
+        )
+        rows = [
+            {"id": new_id(), "document_id": doc.id, "content": c, "content_hash": h, "embedding": e}
+            for c, h, e in result.all()
+        ]
+        for i in range(0, len(rows), 200):
+            await db.execute(insert(DocumentChunk).values(rows[i:i + 200]))
+        await db.commit()
+        
+        return {
+            "document_id": doc.id,
+            "filename": file.filename,
+            "chunks": len(rows)
+        }
+    
+    # Extract text
     if file.filename.endswith(".pdf"):
         pdf = PdfReader(BytesIO(content))
         text = "\n".join([page.extract_text() or "" for page in pdf.pages])
@@ -247,22 +377,23 @@ async def upload_document(file: UploadFile = File(...), db: AsyncSession = Depen
     # Create document
     doc = Document(
         id=new_id(),
-        user_id="test-user",  # TODO: use real auth
-        filename=file.filename
+        user_id=user_id,
+        filename=file.filename,
+        content_hash=file_hash
     )
     db.add(doc)
     await db.flush()
     
-    # Chunk and embed
+    # Chunk and embed (identical chunks reuse cached vectors)
     chunks = RAGService.chunk_text(text)
+    embeddings = await RAGService.embed_chunks(db, chunks)
     
-    for i, chunk_text in enumerate(chunks):
-        embedding = LLMService.embed(chunk_text)
-        
+    for chunk_text, embedding in zip(chunks, embeddings):
         chunk = DocumentChunk(
             id=new_id(),
             document_id=doc.id,
             content=chunk_text,
+            content_hash=content_hash(chunk_text),
             embedding=embedding
         )
         db.add(chunk)
@@ -275,28 +406,32 @@ async def upload_document(file: UploadFile = File(...), db: AsyncSession = Depen
         "chunks": len(chunks)
     }
 
-@app.get("/documents")
-async def list_documents(user_id: str, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(Document).where(Document.user_id == user_id))
-    docs = result.scalars().all()
-    
-    return [
-        {
-            "id": d.id,
-            "filename": d.filename,
-            "chunks": len(d.chunks),
-            "created_at": str(d.created_at)
-        }
-        for d in docs
-    ]
+@app.get("/documents", response_model=List[DocumentOut])
+async def list_documents(user_id: str, request: Request, db: AsyncSession = Depends(get_db)):
+    chunk_count = (
+        select(func.count(DocumentChunk.id))
+        .where(DocumentChunk.document_id == Document.id)
+        .scalar_subquery()
+    )
+    result = await db.execute(
+        select(Document.id, Document.filename, Document.created_at, chunk_count.label("chunks"))
+        .where(Document.user_id == user_id, Document.deleting.is_(False))
+    )
+    return etag_response(request, document_list, result.all())
 
 @app.delete("/documents/{doc_id}")
-async def delete_document(doc_id: str, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(Document).where(Document.id == doc_id))
-    doc = result.scalar_one_or_none()
-    if doc:
-        await db.delete(doc)
-        await db.commit()
+async def delete_document(doc_id: str, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db)):
+    # Hide it and detach it from conversations now; chunks are removed in batches after the response
+    result = await db.execute(
+        update(Document)
+        .where(Document.id == doc_id, Document.deleting.is_(False))
+        .values(deleting=True)
+    )
+    await db.execute(delete(ConversationDocument).where(ConversationDocument.document_id == doc_id))
+    await db.commit()
+    retrieval_cache.invalidate_document(doc_id)
+    if result.rowcount:
+        background_tasks.add_task(purge_document, doc_id)
     return {"status": "deleted"}
 
 @app.post("/conversations/{conv_id}/attach_document")
@@ -318,11 +453,43 @@ async def attach_document(conv_id: str, document_id: str, db: AsyncSession = Dep
         document_id=document_id
     )
     db.add(link)
+    await ensure_not_deleting(db, Conversation, conv_id, "Conversation not found")
+    await ensure_not_deleting(db, Document, document_id, "Document not found")
     await db.commit()
     
     return {"message": "Attached successfully"}
 
 
+# ADMIN ROUTES
+def require_admin(request: Request):
+    if not PROFILING_ENABLED or not PROFILE_ADMIN_TOKEN:
+        raise HTTPException(404, "Not found")
+    token = request.headers.get("x-admin-token", "")
+    if not hmac.compare_digest(token.encode(), PROFILE_ADMIN_TOKEN.encode()):
+        raise HTTPException(403, "Forbidden")
+
+@app.get("/admin/profiles", dependencies=[Depends(require_admin)])
+def list_profiles():
+    return {"profiles": [p.summary() for p in profiles.list()]}
+
+@app.get("/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+def get_profile(profile_id: str, limit: int = 25):
+    profile = profiles.get(profile_id)
+    if not profile:
+        raise HTTPException(404, "Profile not found")
+    return profile.top(limit)
+
+@app.get("/admin/profiles/{profile_id}/collapsed", dependencies=[Depends(require_admin)])
+def download_profile(profile_id: str):
+    profile = profiles.get(profile_id)
+    if not profile:
+        raise HTTPException(404, "Profile not found")
+    return PlainTextResponse(
+        profile.collapsed(),
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.txt"'}
+    )
+
+
 @app.get("/")
 def root():
     return {"message": "BOT GPT API - Simplified Version"}
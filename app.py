@@ -1,10 +1,82 @@
+import threading
 import streamlit as st
 import requests
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
 
 API = "http://127.0.0.1:8000"
+LIST_TTL = 30  # seconds; lists are also cleared after every change made here
+ETAG_ENTRIES = 64  # most recently fetched lists kept for revalidation
 
 st.set_page_config(page_title="BOT GPT", page_icon="💬", layout="wide")
 
+# =============================================================================
+# API CLIENT
+# =============================================================================
+
+@st.cache_resource
+def get_session():
+    # One pooled session for all reruns, so connections are reused
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+    return session
+
+class ETagStore:
+    # Small LRU shared by all sessions, so lists of users no longer active age out
+    
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+    
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+@st.cache_resource
+def get_etags():
+    return ETagStore(ETAG_ENTRIES)
+
+http = get_session()
+
+def get_json(path, params=None):
+    # Revalidate with the last ETag; the backend answers 304 if nothing changed
+    key = (path, tuple(sorted((params or {}).items())))
+    etags = get_etags()
+    cached = etags.get(key)
+    headers = {"If-None-Match": cached[0]} if cached else {}
+    
+    res = http.get(f"{API}{path}", params=params, headers=headers)
+    if res.status_code == 304 and cached:
+        return cached[1]
+    
+    data = res.json()
+    if "ETag" in res.headers:
+        etags.put(key, (res.headers["ETag"], data))
+    return data
+
+@st.cache_data(ttl=LIST_TTL, show_spinner=False)
+def fetch_users():
+    return get_json("/users")["users"]
+
+@st.cache_data(ttl=LIST_TTL, show_spinner=False)
+def fetch_conversations(user_id):
+    return get_json("/conversations", {"user_id": user_id})["conversations"]
+
+@st.cache_data(ttl=LIST_TTL, show_spinner=False)
+def fetch_documents(user_id):
+    return get_json("/documents", {"user_id": user_id})
+
 # =============================================================================
 # SIDEBAR - USER MANAGEMENT
 # =============================================================================
@@ -20,7 +92,7 @@ with st.sidebar:
     
     with tab1:
         try:
-            users = requests.get(f"{API}/users").json()["users"]
+            users = fetch_users()
             if users:
                 selected = st.selectbox(
                     "Choose user:",
@@ -42,7 +114,8 @@ with st.sidebar:
             
             if st.form_submit_button("Create"):
                 try:
-                    user = requests.post(f"{API}/users", json={"name": name, "email": email}).json()
+                    user = http.post(f"{API}/users", json={"name": name, "email": email}).json()
+                    fetch_users.clear()
                     st.session_state.user = user
                     st.success("Created!")
                     st.rerun()
@@ -93,11 +166,12 @@ with tab1:
     with col1:
         if st.button("🗨️ Start Open Chat", use_container_width=True):
             try:
-                res = requests.post(f"{API}/conversations", json={
+                res = http.post(f"{API}/conversations", json={
                     "user_id": st.session_state.user["id"],
                     "first_message": "Hello!",
                     "mode": "open"
                 }).json()
+                fetch_conversations.clear()
                 
                 st.session_state.conversation = res["conversation_id"]
                 st.session_state.mode = "open"
@@ -112,11 +186,12 @@ with tab1:
     with col2:
         if st.button("📚 Start RAG Chat", use_container_width=True):
             try:
-                res = requests.post(f"{API}/conversations", json={
+                res = http.post(f"{API}/conversations", json={
                     "user_id": st.session_state.user["id"],
                     "first_message": "Hello!",
                     "mode": "rag"
                 }).json()
+                fetch_conversations.clear()
                 
                 st.session_state.conversation = res["conversation_id"]
                 st.session_state.mode = "rag"
@@ -148,7 +223,8 @@ with tab1:
                         with st.spinner("Processing..."):
                             try:
                                 files = {"file": (file.name, file, file.type)}
-                                res = requests.post(f"{API}/documents/upload", files=files).json()
+                                res = http.post(f"{API}/documents/upload", files=files).json()
+                                fetch_documents.clear()
                                 st.session_state.last_doc = res["document_id"]
                                 st.success(f"✅ Uploaded ({res['chunks']} chunks)")
                             except Exception as e:
@@ -158,7 +234,7 @@ with tab1:
                     if st.session_state.get("last_doc"):
                         if st.button("Attach to Chat"):
                             try:
-                                requests.post(
+                                http.post(
                                     f"{API}/conversations/{st.session_state.conversation}/attach_document",
                                     params={"document_id": st.session_state.last_doc}
                                 )
@@ -187,10 +263,11 @@ with tab1:
             with st.chat_message("assistant"):
                 with st.spinner("Thinking..."):
                     try:
-                        res = requests.post(
+                        res = http.post(
                             f"{API}/conversations/{st.session_state.conversation}/messages",
                             json={"content": prompt}
                         ).json()
+                        fetch_conversations.clear()
                         
                         reply = res["assistant_response"]
                         st.write(reply)
@@ -206,10 +283,7 @@ with tab2:
     st.subheader("📋 Your Conversations")
     
     try:
-        convs = requests.get(
-            f"{API}/conversations",
-            params={"user_id": st.session_state.user["id"]}
-        ).json()["conversations"]
+        convs = fetch_conversations(st.session_state.user["id"])
         
         if convs:
             for conv in convs:
@@ -223,7 +297,7 @@ with tab2:
                 with col2:
                     if st.button("Resume", key=f"r{conv['id']}", use_container_width=True):
                         try:
-                            detail = requests.get(f"{API}/conversations/{conv['id']}").json()
+                            detail = http.get(f"{API}/conversations/{conv['id']}").json()
                             st.session_state.conversation = conv['id']
                             st.session_state.mode = conv['mode']
                             st.session_state.messages = [
@@ -236,7 +310,8 @@ with tab2:
                 
                 with col3:
                     if st.button("Delete", key=f"d{conv['id']}", use_container_width=True):
-                        requests.delete(f"{API}/conversations/{conv['id']}")
+                        http.delete(f"{API}/conversations/{conv['id']}")
+                        fetch_conversations.clear()
                         st.rerun()
                 
                 st.divider()
@@ -258,7 +333,8 @@ with tab3:
         with st.spinner("Processing..."):
             try:
                 files = {"file": (file.name, file, file.type)}
-                res = requests.post(f"{API}/documents/upload", files=files).json()
+                res = http.post(f"{API}/documents/upload", files=files).json()
+                fetch_documents.clear()
                 st.success(f"✅ Uploaded: {res['chunks']} chunks")
                 st.rerun()
             except Exception as e:
@@ -268,10 +344,7 @@ with tab3:
     
     # List documents
     try:
-        docs = requests.get(
-            f"{API}/documents",
-            params={"user_id": st.session_state.user["id"]}
-        ).json()
+        docs = fetch_documents(st.session_state.user["id"])
         
         if docs:
             for doc in docs:
@@ -283,7 +356,8 @@ with tab3:
                 
                 with col2:
                     if st.button("Delete", key=f"del{doc['id']}", use_container_width=True):
-                        requests.delete(f"{API}/documents/{doc['id']}")
+                        http.delete(f"{API}/documents/{doc['id']}")
+                        fetch_documents.clear()
                         st.rerun()
                 
                 st.divider()
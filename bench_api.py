@@ -0,0 +1,88 @@
+"""
+Throughput of the list endpoints.
+
+Seeds a throwaway SQLite database, then calls /users, /conversations and
+/documents in a loop through an in-process ASGI client, so the numbers cover
+routing, the query and serialization but no network:
+
+    python bench_api.py --seconds 3
+
+Run it on two checkouts to compare. The model and Groq are never called.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark BOT GPT list endpoints")
+    parser.add_argument("--seconds", type=float, default=3.0, help="time per endpoint")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--conversations", type=int, default=500)
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--chunks", type=int, default=5, help="chunks per document")
+    return parser.parse_args()
+
+
+async def seed(args):
+    from sqlalchemy import insert
+    from database import init_db, SessionLocal, User, Conversation, Document, DocumentChunk, new_id
+    
+    await init_db()
+    async with SessionLocal() as db:
+        await db.execute(insert(User), [
+            {"id": f"u{i}", "name": f"User {i}", "email": f"u{i}@example.com"}
+            for i in range(args.users)
+        ])
+        await db.execute(insert(Conversation), [
+            {"id": new_id(), "user_id": "u0", "mode": "open", "title": f"Conversation {i}", "total_tokens": i}
+            for i in range(args.conversations)
+        ])
+        docs = [{"id": new_id(), "user_id": "u0", "filename": f"doc{i}.txt"} for i in range(args.documents)]
+        await db.execute(insert(Document), docs)
+        await db.execute(insert(DocumentChunk), [
+            {"id": new_id(), "document_id": d["id"], "content": "word " * 500, "embedding": [0.1] * 384}
+            for d in docs for _ in range(args.chunks)
+        ])
+        await db.commit()
+
+
+async def run(args):
+    import httpx
+    from api import app
+    
+    await seed(args)
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for path, params in [
+            ("/users", {}),
+            ("/conversations", {"user_id": "u0"}),
+            ("/documents", {"user_id": "u0"}),
+        ]:
+            response = await client.get(path, params=params)
+            if response.status_code != 200:
+                print(f"{path}: HTTP {response.status_code}")
+                continue
+            
+            count = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < args.seconds:
+                await client.get(path, params=params)
+                count += 1
+            print(f"{path}: {count / (time.perf_counter() - start):.1f} req/s")
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Must be set before database.py is imported
+        os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}"
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,41 @@
 import os
 import uuid
+import random
+import asyncio
+import logging
 from datetime import datetime
-from sqlalchemy import Column, String, DateTime, ForeignKey, Text, JSON, Integer, create_engine
+from sqlalchemy import (
+    Column, String, DateTime, ForeignKey, Text, JSON, Integer, Boolean,
+    create_engine, inspect, event, select, delete, false
+)
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import relationship, declarative_base, sessionmaker
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 
+logger = logging.getLogger(__name__)
+
 # Load environment
 from dotenv import load_dotenv
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./bot_gpt.db")
+# SQLite ignores ON DELETE CASCADE unless foreign keys are enforced, which
+# uploads can't satisfy until they stop using the placeholder "test-user"
+SQLITE_FOREIGN_KEYS = os.getenv("SQLITE_FOREIGN_KEYS", "0") == "1"
+DELETE_BATCH_SIZE = int(os.getenv("DELETE_BATCH_SIZE", "500"))
 
 # Setup
 Base = declarative_base()
 engine = create_async_engine(DATABASE_URL, echo=False)
 SessionLocal = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+if SQLITE_FOREIGN_KEYS and engine.dialect.name == "sqlite":
+    @event.listens_for(engine.sync_engine, "connect")
+    def enable_foreign_keys(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
 # Dependency
 async def get_db():
     async with SessionLocal() as session:
@@ -42,12 +62,15 @@ class Conversation(Base):
     __tablename__ = "conversations"
     
     id = Column(String, primary_key=True, default=new_id)
-    user_id = Column(String, ForeignKey("users.id"), nullable=False)
+    user_id = Column(String, ForeignKey("users.id"), nullable=False, index=True)
     mode = Column(String, default="open")
     title = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     total_tokens = Column(Integer, default=0)
+    summary = Column(Text)  # Rolling summary of compacted older turns
+    summarized_until = Column(DateTime)  # created_at of the last message folded into summary
+    deleting = Column(Boolean, nullable=False, default=False, server_default=false())
     
     user = relationship("User", back_populates="conversations")
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
@@ -58,7 +81,9 @@ class Message(Base):
     __tablename__ = "messages"
     
     id = Column(String, primary_key=True, default=new_id)
-    conversation_id = Column(String, ForeignKey("conversations.id"), nullable=False)
+    conversation_id = Column(
+        String, ForeignKey("conversations.id", ondelete="CASCADE"), nullable=False, index=True
+    )
     role = Column(String) 
     content = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -71,9 +96,11 @@ class Document(Base):
     __tablename__ = "documents"
     
     id = Column(String, primary_key=True, default=new_id)
-    user_id = Column(String, ForeignKey("users.id"), nullable=False)
+    user_id = Column(String, ForeignKey("users.id"), nullable=False, index=True)
     filename = Column(String, nullable=False)
+    content_hash = Column(String, index=True)  # sha256 of the uploaded bytes
     created_at = Column(DateTime, default=datetime.utcnow)
+    deleting = Column(Boolean, nullable=False, default=False, server_default=false())
     
     user = relationship("User", back_populates="documents")
     conversations = relationship("Conversation", secondary="conversation_documents", back_populates="documents")
@@ -84,8 +111,9 @@ class DocumentChunk(Base):
     __tablename__ = "document_chunks"
     
     id = Column(String, primary_key=True, default=new_id)
-    document_id = Column(String, ForeignKey("documents.id"), nullable=False)
+    document_id = Column(String, ForeignKey("documents.id", ondelete="CASCADE"), nullable=False, index=True)
     content = Column(Text, nullable=False)
+    content_hash = Column(String, index=True)  # sha256 of content
     embedding = Column(JSON)  # List of floats
     
     document = relationship("Document", back_populates="chunks")
@@ -95,11 +123,135 @@ class ConversationDocument(Base):
     __tablename__ = "conversation_documents"
     
     id = Column(String, primary_key=True, default=new_id)
-    conversation_id = Column(String, ForeignKey("conversations.id"))
-    document_id = Column(String, ForeignKey("documents.id"))
+    conversation_id = Column(String, ForeignKey("conversations.id", ondelete="CASCADE"), index=True)
+    document_id = Column(String, ForeignKey("documents.id", ondelete="CASCADE"), index=True)
+
+
+class EmbeddingCache(Base):
+    __tablename__ = "embedding_cache"
+    
+    content_hash = Column(String, primary_key=True)  # sha256 of the embedded text
+    embedding = Column(JSON, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+# Helper
+async def insert_ignore(session, model, rows: list):
+    # INSERT that skips rows whose primary key already exists
+    if not rows:
+        return
+    dialect = session.bind.dialect.name
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+        await session.execute(insert(model).on_conflict_do_nothing().values(rows))
+    elif dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+        await session.execute(insert(model).on_conflict_do_nothing().values(rows))
+    elif dialect in ("mysql", "mariadb"):
+        from sqlalchemy import insert
+        await session.execute(insert(model).prefix_with("IGNORE").values(rows))
+    else:
+        # Portable fallback: skip keys already present, and if another writer
+        # inserts one in between, drop this batch rather than the transaction
+        from sqlalchemy import insert
+        key = model.__table__.primary_key.columns.values()[0]
+        result = await session.execute(select(key).where(key.in_([r[key.name] for r in rows])))
+        existing = set(result.scalars())
+        rows = [r for r in rows if r[key.name] not in existing]
+        if rows:
+            try:
+                async with session.begin_nested():
+                    await session.execute(insert(model).values(rows))
+            except IntegrityError:
+                logger.info("Skipped %d %s rows inserted concurrently", len(rows), model.__tablename__)
+
+
+# Background deletion
+async def write_with_retry(work, attempts: int = 8):
+    # Every worker may purge the same rows (e.g. at startup); deletes are
+    # idempotent, so losing the SQLite write lock only means waiting and retrying
+    for attempt in range(attempts):
+        try:
+            async with SessionLocal() as session:
+                result = await work(session)
+                await session.commit()
+                return result
+        except OperationalError as e:
+            if "database is locked" not in str(e) or attempt == attempts - 1:
+                raise
+            await asyncio.sleep(0.05 * 2 ** attempt * (1 + random.random()))
+
+async def delete_in_batches(model, column, value, batch_size: int = DELETE_BATCH_SIZE):
+    # Short transactions so the write lock is released between batches
+    async def delete_batch(session):
+        batch = select(model.id).where(column == value).limit(batch_size).scalar_subquery()
+        result = await session.execute(delete(model).where(model.id.in_(batch)))
+        return result.rowcount
+    
+    while await write_with_retry(delete_batch) >= batch_size:
+        pass
+
+async def delete_with_children(model, row_id: str, children):
+    # Final sweep in one transaction, catching rows a writer added after its batch ran
+    async def sweep(session):
+        for child, column in children:
+            await session.execute(delete(child).where(column == row_id))
+        await session.execute(delete(model).where(model.id == row_id))
+    
+    await write_with_retry(sweep)
+
+async def purge_document(doc_id: str):
+    children = [
+        (DocumentChunk, DocumentChunk.document_id),
+        (ConversationDocument, ConversationDocument.document_id),
+    ]
+    for child, column in children:
+        await delete_in_batches(child, column, doc_id)
+    await delete_with_children(Document, doc_id, children)
+
+async def purge_conversation(conv_id: str):
+    children = [
+        (Message, Message.conversation_id),
+        (ConversationDocument, ConversationDocument.conversation_id),
+    ]
+    for child, column in children:
+        await delete_in_batches(child, column, conv_id)
+    await delete_with_children(Conversation, conv_id, children)
+
+async def purge_pending():
+    # Finish deletions interrupted by a restart
+    async with SessionLocal() as session:
+        doc_ids = (await session.scalars(select(Document.id).where(Document.deleting.is_(True)))).all()
+        conv_ids = (await session.scalars(select(Conversation.id).where(Conversation.deleting.is_(True)))).all()
+    # Random order so workers starting together mostly work on different rows
+    pending = [(purge_document, i) for i in doc_ids] + [(purge_conversation, i) for i in conv_ids]
+    random.shuffle(pending)
+    for purge, row_id in pending:
+        try:
+            await purge(row_id)
+        except Exception:
+            logger.exception("Purge of %s failed; it is retried on next startup", row_id)
 
 
 # Initialize database
+def migrate_schema(conn):
+    # create_all never alters existing tables, so add new nullable columns and indexes by hand
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                col_type = column.type.compile(dialect=conn.dialect)
+                default = ""
+                if column.server_default is not None:
+                    default = " DEFAULT " + str(column.server_default.arg.compile(dialect=conn.dialect))
+                conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}{default}")
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(migrate_schema)
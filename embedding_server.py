@@ -0,0 +1,215 @@
+"""
+Shared embedding server.
+
+Every API worker normally loads its own copy of the embedding model. Run this
+once instead and point the workers at it with EMBED_SOCKET:
+
+    python embedding_server.py --socket /tmp/bot_gpt_embed.sock --threads 4
+    EMBED_SOCKET=/tmp/bot_gpt_embed.sock uvicorn api:app --workers 4
+
+Requests from all workers are queued and encoded together in batches.
+Frames are a 4-byte big-endian length followed by a JSON body:
+{"texts": [...]} in, {"embeddings": [[...], ...]} or {"error": "..."} out.
+"""
+import os
+import asyncio
+import socket
+import struct
+import argparse
+import threading
+import orjson
+from typing import List
+
+EMBED_MODEL = "all-MiniLM-L6-v2"
+EMBED_SOCKET = os.getenv("EMBED_SOCKET", "/tmp/bot_gpt_embed.sock")
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "0"))  # 0 keeps torch's default
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "64"))
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
+EMBED_TIMEOUT = float(os.getenv("EMBED_TIMEOUT", "120"))  # seconds per request, client side
+
+HEADER = struct.Struct(">I")
+
+
+# CLIENT
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        part = sock.recv(size - len(data))
+        if not part:
+            raise ConnectionError("Embedding server closed the connection")
+        data.extend(part)
+    return bytes(data)
+
+
+class EmbeddingClient:
+    """Blocking client, one persistent connection per thread."""
+    
+    def __init__(self, path: str, timeout: float = EMBED_TIMEOUT, max_batch: int = EMBED_MAX_BATCH):
+        self.path = path
+        self.timeout = timeout
+        self.max_batch = max_batch
+        self._local = threading.local()
+    
+    def _connection(self) -> socket.socket:
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            self._local.sock = sock
+        return sock
+    
+    def _close(self):
+        sock = getattr(self._local, "sock", None)
+        self._local.sock = None
+        if sock is not None:
+            sock.close()
+    
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        # Requests no larger than a server batch keep each round trip short
+        embeddings = []
+        for i in range(0, len(texts), self.max_batch):
+            embeddings.extend(self._request(texts[i:i + self.max_batch]))
+        return embeddings
+    
+    def _request(self, texts: List[str]) -> List[List[float]]:
+        payload = orjson.dumps({"texts": texts})
+        
+        # Retry once on a fresh connection, e.g. after a server restart. A timeout
+        # means the server is busy, so resending would only add to its queue.
+        for attempt in range(2):
+            try:
+                sock = self._connection()
+                sock.sendall(HEADER.pack(len(payload)) + payload)
+                size, = HEADER.unpack(_recv_exact(sock, HEADER.size))
+                response = orjson.loads(_recv_exact(sock, size))
+                break
+            except (ConnectionError, FileNotFoundError):
+                self._close()
+                if attempt:
+                    raise
+            except OSError:
+                # The reply may still arrive later, so this connection can't be reused
+                self._close()
+                raise
+        
+        if "error" in response:
+            raise RuntimeError(f"Embedding server error: {response['error']}")
+        return response["embeddings"]
+
+
+# SERVER
+class EmbeddingServer:
+    
+    def __init__(self, model, max_batch: int = EMBED_MAX_BATCH, wait_ms: float = EMBED_BATCH_WAIT_MS):
+        self.model = model
+        self.max_batch = max_batch
+        self.wait = wait_ms / 1000
+        self.queue = asyncio.Queue()
+    
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                header = await reader.readexactly(HEADER.size)
+                size, = HEADER.unpack(header)
+                body = await reader.readexactly(size)
+                
+                try:
+                    texts = orjson.loads(body)["texts"]
+                    if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+                        raise ValueError('"texts" must be a list of strings')
+                except (orjson.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+                    response = {"error": f"Bad request: {e!r}"}
+                else:
+                    future = asyncio.get_running_loop().create_future()
+                    await self.queue.put((texts, future))
+                    try:
+                        response = {"embeddings": await future}
+                    except Exception as e:
+                        response = {"error": str(e)}
+                
+                payload = orjson.dumps(response)
+                writer.write(HEADER.pack(len(payload)) + payload)
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            writer.close()
+    
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Gather requests from all workers until the batch is full or the wait is over
+            batch = [await self.queue.get()]
+            count = len(batch[0][0])
+            deadline = loop.time() + self.wait
+            while count < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                count += len(item[0])
+            
+            texts = [text for item_texts, _ in batch for text in item_texts]
+            try:
+                embeddings = await loop.run_in_executor(None, self.encode, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            start = 0
+            for item_texts, future in batch:
+                end = start + len(item_texts)
+                if not future.done():
+                    future.set_result(embeddings[start:end])
+                start = end
+    
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        return self.model.encode(texts, batch_size=self.max_batch, convert_to_tensor=False).tolist()
+    
+    async def serve(self, path: str):
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.handle, path=path)
+        os.chmod(path, 0o660)
+        batcher = asyncio.create_task(self.batcher())
+        print(f"Embedding server listening on {path}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared embedding server for BOT GPT")
+    parser.add_argument("--socket", default=EMBED_SOCKET)
+    parser.add_argument("--threads", type=int, default=EMBED_THREADS, help="torch CPU threads")
+    parser.add_argument("--max-batch", type=int, default=EMBED_MAX_BATCH)
+    parser.add_argument("--wait-ms", type=float, default=EMBED_BATCH_WAIT_MS)
+    args = parser.parse_args()
+    
+    if args.threads:
+        import torch
+        torch.set_num_threads(args.threads)
+    
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(EMBED_MODEL)
+    
+    server = EmbeddingServer(model, args.max_batch, args.wait_ms)
+    try:
+        asyncio.run(server.serve(args.socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,167 @@
 import os
 import math
+import asyncio
+import hashlib
+import logging
+import threading
 import httpx
-from typing import List
-from sentence_transformers import SentenceTransformer
+from collections import OrderedDict
+from typing import List, Optional
+from embedding_server import EMBED_MODEL, EmbeddingClient
+
+logger = logging.getLogger(__name__)
 
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 GROQ_URL = "https://api.groq.com/openai/v1/chat/completions"
 MODEL = "llama-3.1-8b-instant"
+EMBED_SOCKET = os.getenv("EMBED_SOCKET")  # Unix socket of a shared embedding server
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "2048"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "256"))
+RAG_TOKEN_BUDGET = int(os.getenv("RAG_TOKEN_BUDGET", "1500"))
+RAG_MIN_SCORE = float(os.getenv("RAG_MIN_SCORE", "0.25"))
+RAG_DUPLICATE_SCORE = 0.95  # Chunks this similar to an already picked one add nothing
+RAG_MAX_CANDIDATES = 20
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "512"))
+RETRIEVAL_CACHE_SCORE = 0.97  # Query similarity needed to reuse a cached retrieval
+
+# Embeddings come from the shared server when configured, otherwise from a
+# model loaded once in this process on first use
+embed_client = EmbeddingClient(EMBED_SOCKET) if EMBED_SOCKET else None
+_embed_model = None
+_embed_model_lock = threading.Lock()
+
+
+def get_embed_model():
+    global _embed_model
+    with _embed_model_lock:
+        if _embed_model is None:
+            from sentence_transformers import SentenceTransformer
+            _embed_model = SentenceTransformer(EMBED_MODEL)
+    return _embed_model
+
+
+def content_hash(data) -> str:
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
 
-# Load embedding model once
-embed_model = SentenceTransformer('all-MiniLM-L6-v2')
+class EmbeddingLRU:
+    """In-process LRU of embeddings keyed by content hash."""
+    
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+    
+    def put(self, key: str, value: List[float]):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+class RetrievalCache:
+    """Recent retrievals per conversation: (query embedding, document ids, chunk ids)."""
+    
+    def __init__(self, max_size: int, per_conversation: int = 4):
+        self.max_size = max_size
+        self.per_conversation = per_conversation
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, conversation_id: str, document_ids, query_embedding: List[float]) -> Optional[List[str]]:
+        document_ids = frozenset(document_ids)
+        with self._lock:
+            entries = self._items.get(conversation_id)
+            if not entries:
+                return None
+            self._items.move_to_end(conversation_id)
+            for embedding, doc_ids, chunk_ids in entries:
+                if doc_ids == document_ids and \
+                        RAGService.cosine_similarity(query_embedding, embedding) >= RETRIEVAL_CACHE_SCORE:
+                    return chunk_ids
+        return None
+    
+    def put(self, conversation_id: str, document_ids, query_embedding: List[float], chunk_ids: List[str]):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            entries = self._items.setdefault(conversation_id, [])
+            entries.insert(0, (query_embedding, frozenset(document_ids), chunk_ids))
+            del entries[self.per_conversation:]
+            self._items.move_to_end(conversation_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+    
+    def invalidate_conversation(self, conversation_id: str):
+        with self._lock:
+            self._items.pop(conversation_id, None)
+    
+    def invalidate_document(self, document_id: str):
+        with self._lock:
+            for conversation_id in list(self._items):
+                entries = [e for e in self._items[conversation_id] if document_id not in e[1]]
+                if entries:
+                    self._items[conversation_id] = entries
+                else:
+                    del self._items[conversation_id]
+
+
+embedding_lru = EmbeddingLRU(EMBED_CACHE_SIZE)
+retrieval_cache = RetrievalCache(RETRIEVAL_CACHE_SIZE)
+
+# Local tokenizer for prompt budgeting. tiktoken downloads its BPE file on first
+# use (with no timeout) unless TIKTOKEN_CACHE_DIR already holds it, so it is
+# loaded in a background thread on the first count and waited for at most
+# TOKENIZER_LOAD_TIMEOUT. Until it is ready, budgets use ~4 chars per token.
+TOKENIZER_LOAD_TIMEOUT = float(os.getenv("TOKENIZER_LOAD_TIMEOUT", "2"))
+_encoding = None
+_encoding_loader = None
+_encoding_lock = threading.Lock()
+
+
+def _load_encoding():
+    global _encoding
+    try:
+        import tiktoken
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(
+            "tiktoken cl100k_base unavailable (%r); token budgets use a chars/4 estimate. "
+            "Warm TIKTOKEN_CACHE_DIR to use the real tokenizer (see README).", e
+        )
+
+
+def get_encoding():
+    global _encoding_loader
+    if _encoding is None and _encoding_loader is None:
+        with _encoding_lock:
+            if _encoding_loader is None:
+                _encoding_loader = threading.Thread(target=_load_encoding, daemon=True)
+                _encoding_loader.start()
+                _encoding_loader.join(TOKENIZER_LOAD_TIMEOUT)
+                if _encoding_loader.is_alive():
+                    logger.warning("tiktoken is still loading; using a chars/4 estimate until it is ready")
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
 
 
 class LLMService:
@@ -40,9 +192,107 @@ class LLMService:
     
     @staticmethod
     def embed(text: str) -> List[float]:
-        if len(text) > 8000:
-            text = text[:8000]
-        return embed_model.encode(text, convert_to_tensor=False).tolist()
+        key = content_hash(text)
+        cached = embedding_lru.get(key)
+        if cached is not None:
+            return cached
+        
+        embedding = LLMService.embed_batch([text])[0]
+        embedding_lru.put(key, embedding)
+        return embedding
+    
+    @staticmethod
+    def embed_batch(texts: List[str]) -> List[List[float]]:
+        texts = [t[:8000] for t in texts]
+        if embed_client is not None:
+            return embed_client.embed(texts)
+        return get_embed_model().encode(texts, convert_to_tensor=False).tolist()
+
+
+class ContextService:
+    
+    @staticmethod
+    def message_tokens(content: str) -> int:
+        # Roughly what the chat format adds per message on top of the content
+        return count_tokens(content) + 4
+    
+    @staticmethod
+    async def summarize(summary: Optional[str], messages: List[dict]) -> dict:
+        transcript = "\n".join(f"{m['role'].upper()}: {m['content']}" for m in messages)
+        llm_messages = [
+            {
+                "role": "system",
+                "content": (
+                    "You maintain a running summary of a conversation. Update the summary "
+                    "with the new messages, keeping facts, names, decisions and open questions. "
+                    "Reply with the summary only."
+                )
+            },
+            {
+                "role": "user",
+                "content": f"Current summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"
+            }
+        ]
+        return await LLMService.chat(llm_messages, max_tokens=SUMMARY_MAX_TOKENS)
+    
+    @staticmethod
+    async def build_history(db, conv, new_message: str, budget: int = HISTORY_TOKEN_BUDGET) -> dict:
+        """
+        Return the conversation history plus `new_message`, within `budget` tokens.
+        
+        Turns that no longer fit are folded into `conv.summary`, so only messages
+        after `conv.summarized_until` are ever loaded and re-counted. Only reads
+        the database; the caller persists the updated summary with its own commit.
+        """
+        from sqlalchemy import select
+        from database import Message
+        
+        stmt = select(Message.role, Message.content, Message.created_at).where(
+            Message.conversation_id == conv.id
+        )
+        if conv.summarized_until:
+            stmt = stmt.where(Message.created_at > conv.summarized_until)
+        result = await db.execute(stmt.order_by(Message.created_at))
+        rows = [(r.role, r.content, r.created_at) for r in result.all()]
+        rows.append(("user", new_message, None))  # not written yet
+        
+        sizes = [ContextService.message_tokens(content) for _, content, _ in rows]
+        total = sum(sizes)
+        tokens = 0
+        
+        if total > budget:
+            # Fold the oldest turns until the rest fits in half the budget,
+            # so compaction runs every few turns rather than on each one.
+            # The newest message is always kept verbatim.
+            cut = 0
+            while cut < len(rows) - 1 and total > budget // 2:
+                total -= sizes[cut]
+                cut += 1
+            
+            # Summarize in slices so a long backlog never overflows one call
+            start = 0
+            while start < cut:
+                end, used = start, 0
+                while end < cut and (end == start or used + sizes[end] <= budget):
+                    used += sizes[end]
+                    end += 1
+                folded = [{"role": role, "content": content} for role, content, _ in rows[start:end]]
+                response = await ContextService.summarize(conv.summary, folded)
+                conv.summary = response["content"]
+                conv.summarized_until = rows[end - 1][2]
+                tokens += response["tokens"]
+                start = end
+            rows = rows[cut:]
+        
+        messages = []
+        if conv.summary:
+            messages.append({
+                "role": "system",
+                "content": f"Summary of the earlier conversation:\n{conv.summary}"
+            })
+        messages.extend({"role": role, "content": content} for role, content, _ in rows)
+        
+        return {"messages": messages, "tokens": tokens}
 
 
 class RAGService:
@@ -64,6 +314,49 @@ class RAGService:
         
         return chunks
     
+    @staticmethod
+    async def embed_chunks(db, chunks: List[str]) -> List[List[float]]:
+        """Embed chunks, reusing vectors from the LRU and the embedding_cache table."""
+        from sqlalchemy import select
+        from database import EmbeddingCache, insert_ignore
+        
+        hashes = [content_hash(c) for c in chunks]
+        found = {}
+        for h in hashes:
+            cached = embedding_lru.get(h)
+            if cached is not None:
+                found[h] = cached
+        
+        # Look up the rest in the database
+        missing = list({h for h in hashes if h not in found})
+        for i in range(0, len(missing), 500):
+            result = await db.execute(
+                select(EmbeddingCache.content_hash, EmbeddingCache.embedding)
+                .where(EmbeddingCache.content_hash.in_(missing[i:i + 500]))
+            )
+            for h, embedding in result.all():
+                found[h] = embedding
+                embedding_lru.put(h, embedding)
+        
+        # Embed whatever is left in one batch
+        todo = {}
+        for h, chunk in zip(hashes, chunks):
+            if h not in found:
+                todo.setdefault(h, chunk)
+        if todo:
+            # Encoding (or waiting on the embedding server) must not block the event loop
+            embeddings = await asyncio.to_thread(LLMService.embed_batch, list(todo.values()))
+            rows = []
+            for h, embedding in zip(todo.keys(), embeddings):
+                found[h] = embedding
+                embedding_lru.put(h, embedding)
+                rows.append({"content_hash": h, "embedding": embedding})
+            # Another upload may have stored the same chunk meanwhile
+            for i in range(0, len(rows), 200):
+                await insert_ignore(db, EmbeddingCache, rows[i:i + 200])
+        
+        return [found[h] for h in hashes]
+    
     @staticmethod
     def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
         dot = sum(a * b for a, b in zip(vec1, vec2))
@@ -72,7 +365,21 @@ class RAGService:
         return dot / (norm1 * norm2) if norm1 and norm2 else 0.0
     
     @staticmethod
-    async def retrieve_chunks(db, document_ids: List[str], query: str, top_k: int = 3) -> List[str]:
+    async def retrieve_chunks(
+        db,
+        document_ids: List[str],
+        query: str,
+        token_budget: int = RAG_TOKEN_BUDGET,
+        min_score: float = RAG_MIN_SCORE,
+        conversation_id: Optional[str] = None
+    ) -> List[str]:
+        """
+        Return the most relevant chunks that fit in `token_budget` tokens.
+        
+        Chunks scoring below `min_score`, and chunks duplicating one already
+        picked, are skipped. With a `conversation_id`, a follow-up query close to
+        a recent one reuses that retrieval instead of re-scoring every chunk.
+        """
         from sqlalchemy import select
         from database import DocumentChunk
         
@@ -80,22 +387,66 @@ class RAGService:
             return []
         
         # Embed query
-        query_embedding = LLMService.embed(query)
+        query_embedding = await asyncio.to_thread(LLMService.embed, query)
         
-        # Get all chunks
-        stmt = select(DocumentChunk).where(DocumentChunk.document_id.in_(document_ids))
-        result = await db.execute(stmt)
-        chunks = result.scalars().all()
+        chunk_ids = None
+        if conversation_id:
+            chunk_ids = retrieval_cache.get(conversation_id, document_ids, query_embedding)
+        scored_now = chunk_ids is None
         
-        if not chunks:
-            return []
+        if scored_now:
+            # Score chunks without loading their text
+            stmt = select(DocumentChunk.id, DocumentChunk.content_hash, DocumentChunk.embedding).where(
+                DocumentChunk.document_id.in_(document_ids)
+            )
+            result = await db.execute(stmt)
+            
+            scored = []
+            for chunk_id, chunk_hash, embedding in result.all():
+                similarity = RAGService.cosine_similarity(query_embedding, embedding)
+                if similarity >= min_score:
+                    scored.append((similarity, chunk_id, chunk_hash, embedding))
+            
+            scored.sort(reverse=True, key=lambda x: x[0])
+            
+            # Drop exact and near duplicates of higher ranked chunks
+            picked = []
+            seen_hashes = set()
+            for similarity, chunk_id, chunk_hash, embedding in scored:
+                if chunk_hash and chunk_hash in seen_hashes:
+                    continue
+                if any(RAGService.cosine_similarity(embedding, e) >= RAG_DUPLICATE_SCORE for _, e in picked):
+                    continue
+                seen_hashes.add(chunk_hash)
+                picked.append((chunk_id, embedding))
+                if len(picked) >= RAG_MAX_CANDIDATES:
+                    break
+            
+            chunk_ids = [chunk_id for chunk_id, _ in picked]
         
-        # Score and sort
-        scored = []
-        for chunk in chunks:
-            similarity = RAGService.cosine_similarity(query_embedding, chunk.embedding)
-            scored.append((similarity, chunk.content))
+        # Pack in rank order; a chunk that does not fit leaves room for smaller ones
+        packed = []
+        packed_ids = []
+        if chunk_ids:
+            result = await db.execute(
+                select(DocumentChunk.id, DocumentChunk.content).where(DocumentChunk.id.in_(chunk_ids))
+            )
+            contents = dict(result.all())
+            
+            used = 0
+            for chunk_id in chunk_ids:
+                content = contents.get(chunk_id)
+                if content is None:
+                    continue
+                size = count_tokens(content)
+                if used + size > token_budget:
+                    continue
+                packed.append(content)
+                packed_ids.append(chunk_id)
+                used += size
         
-        scored.sort(reverse=True, key=lambda x: x[0])
+        # Cache hits are not stored again, so similar follow-ups don't push out other queries
+        if conversation_id and scored_now:
+            retrieval_cache.put(conversation_id, document_ids, query_embedding, packed_ids)
         
-        return [content for _, content in scored[:top_k]]
+        return packed
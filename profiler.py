@@ -0,0 +1,174 @@
+"""
+Opt-in sampling profiler for individual requests.
+
+Off unless PROFILING_ENABLED=1, in which case the middleware is installed and
+profiles a request when it carries `X-Profile: <PROFILE_TOKEN>` or is picked
+by PROFILE_SAMPLE_RATE. A background thread samples the event loop thread's
+stack every PROFILE_INTERVAL_MS, so handler and retrieval code show up, as does
+any other work the loop ran during that request; embeddings are computed in
+worker threads and only appear as time the handler spent waiting. Profiles are
+kept in a ring buffer of PROFILE_BUFFER_SIZE and served from /admin/profiles
+to holders of the separate PROFILE_ADMIN_TOKEN.
+"""
+import os
+import sys
+import hmac
+import time
+import random
+import threading
+from collections import Counter, deque
+from datetime import datetime
+from typing import List, Optional
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1"
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")  # lets a request ask to be profiled
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")  # reads stored profiles
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_BUFFER_SIZE = int(os.getenv("PROFILE_BUFFER_SIZE", "50"))
+MAX_DEPTH = 128
+
+
+_labels = {}
+
+def frame_label(code) -> str:
+    label = _labels.get(code)
+    if label is None:
+        name = getattr(code, "co_qualname", code.co_name)
+        label = _labels[code] = f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return label
+
+
+class Sampler(threading.Thread):
+    """Counts the stacks of one thread, root first, until stopped."""
+    
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+    
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < MAX_DEPTH:
+                stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+    
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class Profile:
+    
+    def __init__(self, profile_id: str, method: str, path: str, status: int,
+                 started_at: datetime, duration: float, stacks: Counter):
+        self.id = profile_id
+        self.method = method
+        self.path = path
+        self.status = status
+        self.started_at = started_at
+        self.duration_ms = round(duration * 1000, 1)
+        self.stacks = stacks
+        self.samples = sum(stacks.values())
+    
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "samples": self.samples
+        }
+    
+    def top(self, limit: int = 25) -> dict:
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for label in set(stack):
+                total[label] += count
+        return {
+            **self.summary(),
+            "self": [{"frame": f, "samples": n} for f, n in own.most_common(limit)],
+            "total": [{"frame": f, "samples": n} for f, n in total.most_common(limit)]
+        }
+    
+    def collapsed(self) -> str:
+        # One "root;...;leaf count" line per stack, as read by flamegraph.pl and speedscope
+        return "\n".join(f"{';'.join(stack)} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+
+class ProfileBuffer:
+    
+    def __init__(self, max_size: int):
+        self._items = deque(maxlen=max_size)
+        self._lock = threading.Lock()
+    
+    def add(self, profile: Profile):
+        with self._lock:
+            self._items.append(profile)
+    
+    def list(self) -> List[Profile]:
+        with self._lock:
+            return list(reversed(self._items))
+    
+    def get(self, profile_id: str) -> Optional[Profile]:
+        with self._lock:
+            return next((p for p in self._items if p.id == profile_id), None)
+
+
+profiles = ProfileBuffer(PROFILE_BUFFER_SIZE)
+
+
+class ProfilerMiddleware:
+    """ASGI middleware; requests that are not selected pass straight through."""
+    
+    def __init__(self, app, token: str = PROFILE_TOKEN, sample_rate: float = PROFILE_SAMPLE_RATE,
+                 interval_ms: float = PROFILE_INTERVAL_MS):
+        self.app = app
+        self.token = token.encode()
+        self.sample_rate = sample_rate
+        self.interval = interval_ms / 1000
+    
+    def selected(self, scope) -> bool:
+        if self.token:
+            for name, value in scope["headers"]:
+                if name == b"x-profile":
+                    return hmac.compare_digest(value, self.token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith("/admin/") or not self.selected(scope):
+            await self.app(scope, receive, send)
+            return
+        
+        sampler = Sampler(threading.get_ident(), self.interval)
+        profile_id = f"{int(time.time() * 1000):x}{random.getrandbits(16):04x}"
+        status = 500
+        
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())]
+            await send(message)
+        
+        started_at = datetime.utcnow()
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            sampler.stop()
+            profiles.add(Profile(
+                profile_id, scope["method"], scope["path"], status,
+                started_at, time.perf_counter() - start, sampler.stacks
+            ))